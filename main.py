@@ -1,6 +1,7 @@
 import sys
 import subprocess
 import importlib
+import multiprocessing
 
 def check_and_install_libraries():
     required_libraries = [
@@ -20,8 +21,9 @@ def check_and_install_libraries():
             subprocess.check_call([sys.executable, "-m", "pip", "install", library])
             print(f"{library} 安装完成")
 
-# 在程序开始时检查并安装必要的库
-check_and_install_libraries()
+# 在程序开始时检查并安装必要的库；工作进程（Windows 下会重新导入本文件）跳过检查
+if multiprocessing.current_process().name == 'MainProcess':
+    check_and_install_libraries()
 
 import os
 import cv2
@@ -33,6 +35,17 @@ import hashlib
 import random
 import time
 import appdirs
+import argparse
+import asyncio
+import atexit
+import platform
+import queue
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from cryptography.fernet import Fernet
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, 
                              QFileDialog, QProgressBar, QSlider, QCheckBox, QGroupBox, QGridLayout, 
@@ -84,7 +97,13 @@ class Settings:
             "threshold": 15,
             "min_area": 500,
             "blur_size": 5,
-            "reverse_video": False
+            "reverse_video": False,
+            "roi": "",
+            "exclude_rects": "",
+            "auto_overlay_mask": False,
+            "use_spool": False,
+            "output_variants": [],
+            "tuned": {}
         }
         self.load()
 
@@ -107,12 +126,25 @@ class Settings:
         self.settings[key] = value
         self.save()
 
+    def get_tuned(self):
+        """返回本机的自动调优结果，未调优时为空字典"""
+        return self.get("tuned").get(machine_id(), {})
+
+    def set_tuned(self, config):
+        tuned = dict(self.get("tuned"))
+        tuned[machine_id()] = config
+        self.set("tuned", tuned)
+
+def machine_id():
+    # 设置文件可能被同步到其他电脑，调优结果按机器分别保存
+    return f"{platform.node()}-{platform.machine()}-{os.cpu_count()}"
+
 class SettingsDialog(QDialog):
     def __init__(self, settings, parent=None):
         super().__init__(parent)
         self.settings = settings
         self.setWindowTitle("设置")
-        self.setFixedSize(400, 300)
+        self.setFixedSize(400, 480)
         
         layout = QVBoxLayout()
         
@@ -131,6 +163,24 @@ class SettingsDialog(QDialog):
         self.reverse_video_check = QCheckBox("默认倒放视频")
         self.reverse_video_check.setChecked(False)
         layout.addWidget(self.reverse_video_check)
+
+        self.roi_edit = QLineEdit(settings.get("roi"))
+        self.roi_edit.setPlaceholderText("x,y,宽,高（留空为整帧）")
+        layout.addWidget(QLabel("检测区域:"))
+        layout.addWidget(self.roi_edit)
+
+        self.exclude_rects_edit = QLineEdit(settings.get("exclude_rects"))
+        self.exclude_rects_edit.setPlaceholderText("x,y,宽,高; x,y,宽,高")
+        layout.addWidget(QLabel("排除区域（字幕、台标等）:"))
+        layout.addWidget(self.exclude_rects_edit)
+
+        self.auto_overlay_mask_check = QCheckBox("自动检测并排除固定叠加层")
+        self.auto_overlay_mask_check.setChecked(settings.get("auto_overlay_mask"))
+        layout.addWidget(self.auto_overlay_mask_check)
+
+        self.use_spool_check = QCheckBox("保留帧暂存到磁盘（适合内存放不下的长视频）")
+        self.use_spool_check.setChecked(settings.get("use_spool"))
+        layout.addWidget(self.use_spool_check)
         
         button_layout = QHBoxLayout()
         ok_button = QPushButton("确定")
@@ -164,10 +214,20 @@ class SettingsDialog(QDialog):
         self.setLayout(layout)
 
     def accept(self):
+        try:
+            parse_roi(self.roi_edit.text())
+            parse_rects(self.exclude_rects_edit.text())
+        except ValueError as e:
+            QMessageBox.warning(self, "警告", f"区域格式错误: {str(e)}")
+            return
         self.settings.set("threshold", int(self.threshold_edit.text()))
         self.settings.set("min_area", int(self.min_area_edit.text()))
         self.settings.set("blur_size", int(self.blur_size_edit.text()))
         self.settings.set("reverse_video", self.reverse_video_check.isChecked())
+        self.settings.set("roi", self.roi_edit.text().strip())
+        self.settings.set("exclude_rects", self.exclude_rects_edit.text().strip())
+        self.settings.set("auto_overlay_mask", self.auto_overlay_mask_check.isChecked())
+        self.settings.set("use_spool", self.use_spool_check.isChecked())
         super().accept()
 
 class HelpDialog(QDialog):
@@ -252,12 +312,285 @@ class AnimatedProgressBar(QProgressBar):
         self.animation.setEndValue(value)
         self.animation.start()
 
+def parse_rects(text):
+    """把 "x,y,w,h; x,y,w,h" 格式的文本解析为矩形列表"""
+    rects = []
+    for part in text.replace('；', ';').split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        values = [int(v) for v in part.replace('，', ',').split(',')]
+        if len(values) != 4 or values[2] <= 0 or values[3] <= 0:
+            raise ValueError(f"无效的区域: {part}")
+        rects.append(tuple(values))
+    return rects
+
+def parse_roi(text):
+    """解析检测区域，只允许一个矩形，留空时返回 None"""
+    rects = parse_rects(text)
+    if len(rects) > 1:
+        raise ValueError("检测区域只能填写一个矩形")
+    return rects[0] if rects else None
+
+def to_rect(value):
+    """把 [x, y, w, h] 形式的列表转换为矩形"""
+    if (not isinstance(value, (list, tuple)) or len(value) != 4
+            or not all(isinstance(v, int) and not isinstance(v, bool) for v in value)
+            or value[2] <= 0 or value[3] <= 0):
+        raise ValueError(f"无效的区域: {value}")
+    return tuple(value)
+
+def variant_output_path(output_path, variant):
+    """输出版本实际写入的路径：优先使用 output_path，否则在默认输出文件名后加上 suffix"""
+    if variant.get("output_path"):
+        return variant["output_path"]
+    base_name, ext = os.path.splitext(output_path)
+    return f"{base_name}{variant.get('suffix', '')}{ext}"
+
+def check_unique_output_paths(output_paths):
+    # 多个版本写到同一个文件时只有一个版本的结果会保留下来
+    normalized = [os.path.normcase(os.path.abspath(path)) for path in output_paths]
+    if len(set(normalized)) != len(normalized):
+        raise ValueError("多个输出版本的输出路径相同，请用 suffix 或 output_path 区分")
+
+class DiffMask:
+    """帧差分前使用的检测区域裁剪和排除掩码，每个视频只计算一次"""
+
+    def __init__(self, width, height, roi=None, exclude_rects=None):
+        x, y, w, h = roi if roi else (0, 0, width, height)
+        # 把检测区域限制在画面范围内
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(width, x + w), min(height, y + h)
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError("检测区域超出视频画面范围")
+        self.crop = (slice(y0, y1), slice(x0, x1))
+        self.offset = (x0, y0)
+        self.size = (x1 - x0, y1 - y0)
+        self.mask = None
+        for rect in exclude_rects or []:
+            self.exclude(rect)
+
+    def exclude(self, rect):
+        x, y, w, h = rect
+        x -= self.offset[0]
+        y -= self.offset[1]
+        if self.mask is None:
+            self.mask = np.full((self.size[1], self.size[0]), 255, dtype=np.uint8)
+        cv2.rectangle(self.mask, (x, y), (x + w - 1, y + h - 1), 0, -1)
+
+    def exclude_mask(self, overlay):
+        """overlay 为裁剪后坐标系下的二值图，非零处表示需要排除"""
+        if self.mask is None:
+            self.mask = np.full((self.size[1], self.size[0]), 255, dtype=np.uint8)
+        self.mask[overlay > 0] = 0
+
+    def apply_crop(self, frame):
+        return frame[self.crop]
+
+    def apply(self, thresh):
+        if self.mask is None:
+            return thresh
+        return cv2.bitwise_and(thresh, self.mask)
+
+def detect_overlay_mask(input_path, diff_mask, samples=30, persistence=0.8, should_stop=None):
+    """采样若干帧，找出在大多数帧中都存在边缘的像素（台标、滚动字幕条等固定叠加层）
+
+    should_stop 返回 True 时提前结束并返回 None。
+    """
+    cap = cv2.VideoCapture(input_path)
+    if not cap.isOpened():
+        raise IOError("无法打开输入视频文件")
+    try:
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        indices = np.linspace(0, max(total_frames - 1, 0), num=min(samples, max(total_frames, 1)), dtype=int)
+        edge_count = None
+        used = 0
+        for index in indices:
+            if should_stop is not None and should_stop():
+                return None
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+            ret, frame = cap.read()
+            if not ret:
+                continue
+            gray = cv2.cvtColor(diff_mask.apply_crop(frame), cv2.COLOR_BGR2GRAY)
+            edges = cv2.Canny(gray, 100, 200)
+            if edge_count is None:
+                edge_count = np.zeros(edges.shape, dtype=np.uint16)
+            edge_count += edges > 0
+            used += 1
+        if used < 2:
+            return None
+        overlay = (edge_count >= used * persistence).astype(np.uint8) * 255
+        # 膨胀一下，把文字笔画之间的空隙也覆盖进去
+        return cv2.dilate(overlay, np.ones((15, 15), np.uint8))
+    finally:
+        cap.release()
+
+def prepare_gray(frame, diff_mask, blur_size):
+    """裁剪检测区域、转为灰度并模糊，blur_size 必须为奇数"""
+    frame_gray = cv2.cvtColor(diff_mask.apply_crop(frame), cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(frame_gray, (blur_size, blur_size), 0)
+
+def has_significant_change(prev_gray, frame_gray, threshold, min_area, diff_mask=None):
+    diff = cv2.absdiff(frame_gray, prev_gray)
+    _, thresh = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
+    if diff_mask is not None:
+        thresh = diff_mask.apply(thresh)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return any(cv2.contourArea(contour) > min_area for contour in contours)
+
+def read_frames(cap, total_frames, queue_depth=0):
+    """按顺序读取帧；queue_depth 大于0时由后台线程提前解码，与帧比较并行进行"""
+    if queue_depth <= 0:
+        for i in range(total_frames):
+            ret, frame = cap.read()
+            if not ret:
+                logging.warning(f"在第 {i} 帧读取失败")
+                return
+            yield i, frame
+        return
+
+    frames = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        for i in range(total_frames):
+            ret, frame = cap.read()
+            if not ret:
+                logging.warning(f"在第 {i} 帧读取失败")
+                break
+            if not put((i, frame)):
+                return
+        put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def lock_file(f):
+    """对打开的文件加非阻塞的独占锁，已被其他进程加锁时抛出 OSError"""
+    if os.name == 'nt':
+        import msvcrt
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def cleanup_stale_spools():
+    """删除之前崩溃（被强制结束、段错误等）的进程留下的帧缓存目录
+
+    正在使用的缓存目录中的锁文件一直被加锁，进程退出后锁会由系统释放，
+    因此能加锁成功的目录就是没有进程在使用的。
+    """
+    temp_dir = tempfile.gettempdir()
+    for name in os.listdir(temp_dir):
+        directory = os.path.join(temp_dir, name)
+        if not name.startswith("frame_spool_") or not os.path.isdir(directory):
+            continue
+        # 刚创建、还没来得及加锁的目录先跳过
+        if time.time() - os.path.getmtime(directory) < 60:
+            continue
+        try:
+            with open(os.path.join(directory, "lock"), 'r+') as f:
+                lock_file(f)
+        except OSError:
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+        logging.info(f"已删除残留的帧缓存: {directory}")
+
+class FrameSpool:
+    """把保留的帧写入临时目录中的 np.memmap 文件，用法与帧列表相同
+
+    取出的帧都是 memmap 的视图，不会复制到内存，因此倒放等需要随机访问的操作
+    也能处理比内存更大的视频。文件按需成倍扩大，写完后用 trim() 截掉多余部分，
+    占用的磁盘空间与实际保留的帧数相当。扩大文件时会重新映射，之前取出的视图
+    会失效，所以应当全部 append 完之后再读取。
+    处理结束、出错或程序退出时会删除临时文件，崩溃残留的文件由
+    cleanup_stale_spools() 在下次启动时删除。
+    """
+
+    def __init__(self, height, width, initial_capacity=64, max_capacity=None):
+        self.directory = tempfile.mkdtemp(prefix="frame_spool_")
+        self.lock = open(os.path.join(self.directory, "lock"), 'w')
+        lock_file(self.lock)
+        self.filename = os.path.join(self.directory, "frames.raw")
+        self.frame_shape = (height, width, 3)
+        self.max_capacity = max_capacity
+        self.capacity = max(1, min(initial_capacity, max_capacity or initial_capacity))
+        self.frames = np.memmap(self.filename, dtype=np.uint8, mode='w+', shape=(self.capacity,) + self.frame_shape)
+        self.count = 0
+        atexit.register(self.close)
+        logging.info(f"创建帧缓存: {self.filename}")
+
+    def remap(self, capacity):
+        self.frames.flush()
+        # 先释放映射，Windows 下映射中的文件不能改变大小
+        self.frames = None
+        with open(self.filename, 'r+b') as f:
+            f.truncate(capacity * int(np.prod(self.frame_shape)))
+        self.frames = np.memmap(self.filename, dtype=np.uint8, mode='r+', shape=(capacity,) + self.frame_shape)
+        self.capacity = capacity
+
+    def append(self, frame):
+        if self.count == self.capacity:
+            capacity = self.capacity * 2
+            if self.max_capacity:
+                capacity = min(capacity, self.max_capacity)
+            self.remap(max(capacity, self.count + 1))
+        self.frames[self.count] = frame
+        self.count += 1
+
+    def trim(self):
+        """把文件截短到实际保留的帧数"""
+        if self.capacity > max(self.count, 1):
+            self.remap(max(self.count, 1))
+        logging.info(f"帧缓存共 {self.count} 帧")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.frames[:self.count][index]
+
+    def __iter__(self):
+        return iter(self.frames[:self.count])
+
+    def close(self):
+        self.frames = None
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+        # Windows 下仍有视图引用映射时无法删除，留给程序退出时再删一次
+        if not os.path.exists(self.directory):
+            atexit.unregister(self.close)
+
 class VideoProcessor(QThread):
     progress = pyqtSignal(int, str)
     finished = pyqtSignal(str, float, int)
+    variant_finished = pyqtSignal(str, float, int)
     error = pyqtSignal(str)
 
-    def __init__(self, input_path, output_path, threshold, min_area, blur_size, reverse_video):
+    def __init__(self, input_path, output_path, threshold, min_area, blur_size, reverse_video,
+                 roi=None, exclude_rects=None, auto_overlay_mask=False, opencv_threads=None, queue_depth=0,
+                 use_spool=False, variants=None):
         super().__init__()
         self.input_path = input_path
         self.output_path = output_path
@@ -265,10 +598,55 @@ class VideoProcessor(QThread):
         self.min_area = min_area
         self.blur_size = blur_size if blur_size % 2 == 1 else blur_size + 1  # 确保模糊大小为奇数
         self.reverse_video = reverse_video
+        self.roi = roi
+        self.exclude_rects = exclude_rects or []
+        self.auto_overlay_mask = auto_overlay_mask
+        self.opencv_threads = opencv_threads
+        self.queue_depth = queue_depth
+        self.use_spool = use_spool
+        # 每个版本是一个字典，可以覆盖 threshold、min_area、blur_size、reverse_video、fourcc，
+        # 并用 output_path 或 suffix（加在默认输出文件名后）指定输出位置
+        self.variants = variants
+
+    def build_diff_mask(self, width, height):
+        diff_mask = DiffMask(width, height, self.roi, self.exclude_rects)
+        if self.auto_overlay_mask:
+            overlay = detect_overlay_mask(self.input_path, diff_mask)
+            if overlay is not None:
+                diff_mask.exclude_mask(overlay)
+                logging.info(f"自动排除固定叠加层像素: {int(np.count_nonzero(overlay))}")
+        return diff_mask
+
+    def prepare_gray(self, frame, diff_mask, blur_size=None):
+        return prepare_gray(frame, diff_mask, blur_size or self.blur_size)
+
+    def get_variants(self):
+        """补全每个输出版本的参数，未指定的参数沿用处理器本身的设置"""
+        variants = []
+        for variant in self.variants or [{}]:
+            options = {
+                "threshold": self.threshold,
+                "min_area": self.min_area,
+                "blur_size": self.blur_size,
+                "reverse_video": self.reverse_video,
+                "fourcc": "mp4v",
+            }
+            options.update(variant)
+            options["output_path"] = variant_output_path(self.output_path, variant)
+            if options["blur_size"] % 2 == 0:
+                options["blur_size"] += 1
+            variants.append(options)
+        check_unique_output_paths([variant["output_path"] for variant in variants])
+        return variants
 
     def run(self):
+        spool = None
+        cap = None
+        writers = []
         try:
             logging.info(f"开始处理视频: {self.input_path}")
+            if self.opencv_threads is not None:
+                cv2.setNumThreads(self.opencv_threads)
             cap = cv2.VideoCapture(self.input_path)
             if not cap.isOpened():
                 raise IOError("无法打开输入视频文件")
@@ -280,69 +658,317 @@ class VideoProcessor(QThread):
             
             logging.info(f"视频信息: 总帧数={total_frames}, FPS={fps}, 分辨率={width}x{height}")
 
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            out = cv2.VideoWriter(self.output_path, fourcc, fps, (width, height))
-
-            frames_to_keep = []
-            prev_frame = None
-
-            for i in range(total_frames):
-                ret, frame = cap.read()
-                if not ret:
-                    logging.warning(f"在第 {i} 帧读取失败")
-                    break
-
+            diff_mask = self.build_diff_mask(width, height)
+            logging.info(f"检测区域: {diff_mask.size[0]}x{diff_mask.size[1]}, 排除掩码: {diff_mask.mask is not None}")
+
+            # 所有输出版本共用一次解码，每个版本各自判断保留哪些帧并写入自己的输出文件
+            variants = self.get_variants()
+            for variant in variants:
+                fourcc = cv2.VideoWriter_fourcc(*variant["fourcc"])
+                writers.append(cv2.VideoWriter(variant["output_path"], fourcc, fps, (width, height)))
+            blur_sizes = {variant["blur_size"] for variant in variants}
+            kept_counts = [0] * len(variants)
+
+            # 正放的版本边处理边写入；倒放的版本需要先保存保留的帧，
+            # 多个倒放版本共用同一份帧，各自只记录帧的位置
+            frames_to_keep = None
+            reverse_indices = [[] for _ in variants]
+            if any(variant["reverse_video"] for variant in variants):
+                if self.use_spool:
+                    spool = FrameSpool(height, width, max_capacity=total_frames)
+                    frames_to_keep = spool
+                else:
+                    frames_to_keep = []
+            prev_grays = None
+
+            for i, frame in read_frames(cap, total_frames, self.queue_depth):
                 if i < 5 or i > total_frames - 5:  # 保留开头和结尾的5帧
-                    frames_to_keep.append(frame)
-                    continue
-
-                if prev_frame is None:
-                    frames_to_keep.append(frame)
-                    prev_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                    prev_frame = cv2.GaussianBlur(prev_frame, (self.blur_size, self.blur_size), 0)
-                    continue
-
-                frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                frame_gray = cv2.GaussianBlur(frame_gray, (self.blur_size, self.blur_size), 0)
+                    keep = [True] * len(variants)
+                elif prev_grays is None:
+                    keep = [True] * len(variants)
+                    prev_grays = {blur_size: self.prepare_gray(frame, diff_mask, blur_size) for blur_size in blur_sizes}
+                else:
+                    frame_grays = {blur_size: self.prepare_gray(frame, diff_mask, blur_size) for blur_size in blur_sizes}
+                    keep = [has_significant_change(prev_grays[variant["blur_size"]], frame_grays[variant["blur_size"]],
+                                                   variant["threshold"], variant["min_area"], diff_mask)
+                            for variant in variants]
+                    prev_grays = frame_grays
+                    self.progress.emit(int((i + 1) / total_frames * 100), os.path.basename(self.input_path))
+
+                stored_index = None
+                for k, variant in enumerate(variants):
+                    if not keep[k]:
+                        continue
+                    kept_counts[k] += 1
+                    if variant["reverse_video"]:
+                        if stored_index is None:
+                            frames_to_keep.append(frame)
+                            stored_index = len(frames_to_keep) - 1
+                        reverse_indices[k].append(stored_index)
+                    else:
+                        writers[k].write(frame)
+
+            if spool is not None:
+                spool.trim()
+
+            for k, variant in enumerate(variants):
+                if variant["reverse_video"]:
+                    for index in reversed(reverse_indices[k]):
+                        writers[k].write(frames_to_keep[index])
+                    logging.info(f"{variant['output_path']}: 视频帧已倒序")
 
-                diff = cv2.absdiff(frame_gray, prev_frame)
-                _, thresh = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
-                contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                
-                if any(cv2.contourArea(contour) > self.min_area for contour in contours):
-                    frames_to_keep.append(frame)
-
-                prev_frame = frame_gray
-                self.progress.emit(int((i + 1) / total_frames * 100), os.path.basename(self.input_path))
-
-            logging.info(f"保留了 {len(frames_to_keep)} 帧")
+            original_duration = total_frames / fps
+            summaries = []
+            for variant, kept_frames in zip(variants, kept_counts):
+                tw_speed = (kept_frames / fps / original_duration) * 100
+                logging.info(f"{variant['output_path']}: 保留了 {kept_frames} 帧，建议的TW速度: {tw_speed:.2f}%")
+                self.variant_finished.emit(variant["output_path"], tw_speed, kept_frames)
+                summaries.append(f"{os.path.basename(variant['output_path'])}: 保留 {kept_frames} 帧，TW速度 {tw_speed:.2f}%")
+
+            message = "处理成功完成！"
+            if len(variants) > 1:
+                message += "\n" + "\n".join(summaries) + "\n"
+            tw_speed = (kept_counts[0] / fps / original_duration) * 100
+            logging.info(f"处理完成。建议的TW速度: {tw_speed:.2f}%")
+            self.finished.emit(message, tw_speed, kept_counts[0])
+        except Exception as e:
+            logging.exception("处理视频时发生错误")
+            self.error.emit(f"处理视频时发生错误: {str(e)}")
+        finally:
+            if cap is not None:
+                cap.release()
+            for writer in writers:
+                writer.release()
+            if spool is not None:
+                # 先释放指向 memmap 的视图，再删除缓存文件
+                frames_to_keep = frame = None
+                spool.close()
+
+class ThumbnailCache:
+    """预览用的灰度缩略图缓存，超过上限时淘汰最久未使用的条目"""
+
+    def __init__(self, max_items=1000):
+        self.max_items = max_items
+        self.items = OrderedDict()
 
-            if self.reverse_video:
-                frames_to_keep = frames_to_keep[::-1]
-                logging.info("视频帧已倒序")
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+thumbnail_cache = ThumbnailCache()
+
+class PreviewSampler(QThread):
+    """按间隔采样相邻帧对并缩小为灰度缩略图，供参数预览使用"""
+    sampled = pyqtSignal(object)
+    error = pyqtSignal(str)
 
-            for frame in frames_to_keep:
-                out.write(frame)
+    def __init__(self, input_path, roi=None, exclude_rects=None, auto_overlay_mask=False, samples=200,
+                 thumb_width=320, start_time=None, end_time=None):
+        super().__init__()
+        self.input_path = input_path
+        self.roi = roi
+        self.exclude_rects = exclude_rects
+        self.auto_overlay_mask = auto_overlay_mask
+        self.samples = samples
+        self.thumb_width = thumb_width
+        self.start_time = start_time
+        self.end_time = end_time
 
-            cap.release()
-            out.release()
+    def run(self):
+        try:
+            cap = cv2.VideoCapture(self.input_path)
+            if not cap.isOpened():
+                raise IOError("无法打开输入视频文件")
+            try:
+                total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                fps = cap.get(cv2.CAP_PROP_FPS) or 1
+                width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+                diff_mask = DiffMask(width, height, self.roi, self.exclude_rects)
+                if self.auto_overlay_mask:
+                    # 在原始分辨率下检测一次，再和手动排除区域一起缩小到缩略图大小
+                    overlay = detect_overlay_mask(self.input_path, diff_mask,
+                                                  should_stop=self.isInterruptionRequested)
+                    if self.isInterruptionRequested():
+                        return
+                    if overlay is not None:
+                        diff_mask.exclude_mask(overlay)
+                scale = min(1.0, self.thumb_width / diff_mask.size[0])
+                thumb_size = (max(1, int(diff_mask.size[0] * scale)), max(1, int(diff_mask.size[1] * scale)))
+                if diff_mask.mask is not None:
+                    diff_mask.mask = cv2.resize(diff_mask.mask, thumb_size, interpolation=cv2.INTER_NEAREST)
+
+                # 与正式处理一致，跳过开头和结尾的5帧
+                first = max(5, int(self.start_time * fps) if self.start_time else 5)
+                last = min(total_frames - 6, int(self.end_time * fps) if self.end_time else total_frames - 6)
+                step = max(1, (last - first) // self.samples)
+
+                pairs = []
+                for index in range(first, last, step):
+                    if self.isInterruptionRequested():
+                        return
+                    key = (self.input_path, index, self.roi, thumb_size)
+                    pair = thumbnail_cache.get(key)
+                    if pair is None:
+                        pair = self.read_pair(cap, index, diff_mask, thumb_size)
+                        if pair is None:
+                            continue
+                        thumbnail_cache.put(key, pair)
+                    pairs.append(pair)
+            finally:
+                cap.release()
+
+            self.sampled.emit({
+                "pairs": pairs,
+                "scale": scale,
+                "diff_mask": diff_mask,
+                "total_frames": total_frames,
+            })
+        except Exception as e:
+            logging.exception("生成预览时发生错误")
+            self.error.emit(f"生成预览时发生错误: {str(e)}")
+
+    def read_pair(self, cap, index, diff_mask, thumb_size):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, index - 1)
+        pair = []
+        for _ in range(2):
+            ret, frame = cap.read()
+            if not ret:
+                return None
+            gray = cv2.cvtColor(diff_mask.apply_crop(frame), cv2.COLOR_BGR2GRAY)
+            pair.append(cv2.resize(gray, thumb_size, interpolation=cv2.INTER_AREA))
+        return tuple(pair)
+
+def estimate_kept_frames(preview, threshold, min_area, blur_size):
+    """在缩略图上重新执行保留判断，按采样比例估算保留帧数和TW速度"""
+    pairs = preview["pairs"]
+    total_frames = preview["total_frames"]
+    if not pairs or total_frames <= 0:
+        return 0, 0.0
+    scale = preview["scale"]
+    blur_size = max(1, int(blur_size * scale))
+    blur_size = blur_size if blur_size % 2 == 1 else blur_size + 1
+    min_area = min_area * scale * scale
+
+    changed = 0
+    for prev_gray, frame_gray in pairs:
+        prev_gray = cv2.GaussianBlur(prev_gray, (blur_size, blur_size), 0)
+        frame_gray = cv2.GaussianBlur(frame_gray, (blur_size, blur_size), 0)
+        if has_significant_change(prev_gray, frame_gray, threshold, min_area, preview["diff_mask"]):
+            changed += 1
+
+    fixed_frames = min(total_frames, 10)
+    kept_frames = fixed_frames + round(changed / len(pairs) * (total_frames - fixed_frames))
+    return kept_frames, kept_frames / total_frames * 100
+
+def benchmark_sample(input_path, sample_frames, opencv_threads, queue_depth, blur_size):
+    """在工作进程中按指定配置分析视频开头的若干帧（不写出视频），返回分析的帧数"""
+    cv2.setNumThreads(opencv_threads)
+    cap = cv2.VideoCapture(input_path)
+    if not cap.isOpened():
+        raise IOError("无法打开输入视频文件")
+    try:
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        sample_frames = min(sample_frames, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        diff_mask = DiffMask(width, height)
+        blur_size = blur_size if blur_size % 2 == 1 else blur_size + 1
+        prev_gray = None
+        count = 0
+        for _, frame in read_frames(cap, sample_frames, queue_depth):
+            frame_gray = prepare_gray(frame, diff_mask, blur_size)
+            if prev_gray is not None:
+                has_significant_change(prev_gray, frame_gray, 15, 500, diff_mask)
+            prev_gray = frame_gray
+            count += 1
+        return count
+    finally:
+        cap.release()
+
+class AutoTuner(QThread):
+    """用输入视频的一小段尝试不同的工作进程数、OpenCV线程数和预读队列深度，保存吞吐量最高的组合"""
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(dict)
+    error = pyqtSignal(str)
 
-            original_duration = total_frames / fps
-            new_duration = len(frames_to_keep) / fps
-            tw_speed = (new_duration / original_duration) * 100
+    def __init__(self, input_path, settings, sample_frames=200):
+        super().__init__()
+        self.input_path = input_path
+        self.settings = settings
+        self.sample_frames = sample_frames
+        self.blur_size = settings.get("blur_size")
+
+    def candidates(self):
+        cpu_count = os.cpu_count() or 1
+        configs = []
+        for workers in sorted({1, max(1, cpu_count // 2), cpu_count}):
+            for opencv_threads in sorted({1, max(1, cpu_count // workers)}):
+                for queue_depth in (0, 8):
+                    configs.append({"workers": workers, "opencv_threads": opencv_threads, "queue_depth": queue_depth})
+        return configs
 
-            logging.info(f"处理完成。建议的TW速度: {tw_speed:.2f}%")
-            self.finished.emit(f"处理成功完成！", tw_speed, len(frames_to_keep))
+    def run(self):
+        try:
+            configs = self.candidates()
+            best = None
+            best_single = None
+            for i, config in enumerate(configs):
+                fps = self.measure(config)
+                logging.info(f"调优配置 {config}: {fps:.1f} 帧/秒")
+                if best is None or fps > best["fps"]:
+                    best = dict(config, fps=fps)
+                # 单个视频只用一个进程处理，另外记录单进程时最快的配置
+                if config["workers"] == 1 and (best_single is None or fps > best_single["fps"]):
+                    best_single = dict(config, fps=fps)
+                self.progress.emit(int((i + 1) / len(configs) * 100), "性能调优")
+            best["single_opencv_threads"] = best_single["opencv_threads"]
+            best["single_queue_depth"] = best_single["queue_depth"]
+            best["time"] = time.time()
+            self.settings.set_tuned(best)
+            logging.info(f"调优完成，最佳配置: {best}")
+            self.finished.emit(best)
         except Exception as e:
-            logging.exception("处理视频时发生错误")
-            self.error.emit(f"处理视频时发生错误: {str(e)}")
+            logging.exception("性能调优时发生错误")
+            self.error.emit(f"性能调优时发生错误: {str(e)}")
+
+    def measure(self, config):
+        """多个工作进程同时分析样本，返回总吞吐量（帧/秒）"""
+        workers = config["workers"]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # 先让进程启动完毕，避免把进程启动时间算进去
+            for future in [executor.submit(os.getpid) for _ in range(workers)]:
+                future.result()
+            start = time.perf_counter()
+            futures = [executor.submit(benchmark_sample, self.input_path, self.sample_frames,
+                                       config["opencv_threads"], config["queue_depth"], self.blur_size)
+                       for _ in range(workers)]
+            frames = sum(future.result() for future in futures)
+            return frames / max(time.perf_counter() - start, 1e-6)
+
+def check_shared_variants(variants):
+    """批量处理和任务服务中同一组输出版本会用于多个视频，不能写死输出路径"""
+    for variant in variants or []:
+        if variant.get("output_path"):
+            raise ValueError("批量处理和任务服务的输出版本不能指定 output_path，请用 suffix 区分文件名")
 
 class BatchProcessor(QThread):
     progress = pyqtSignal(int, str)
     finished = pyqtSignal()
     error = pyqtSignal(str)
 
-    def __init__(self, video_list, output_dir, threshold, min_area, blur_size, reverse_video):
+    def __init__(self, video_list, output_dir, threshold, min_area, blur_size, reverse_video,
+                 roi=None, exclude_rects=None, auto_overlay_mask=False,
+                 max_workers=1, opencv_threads=None, queue_depth=0, use_spool=False, variants=None,
+                 single_opencv_threads=None, single_queue_depth=0):
         super().__init__()
         self.video_list = video_list
         self.output_dir = output_dir
@@ -350,23 +976,447 @@ class BatchProcessor(QThread):
         self.min_area = min_area
         self.blur_size = blur_size
         self.reverse_video = reverse_video
+        self.roi = roi
+        self.exclude_rects = exclude_rects
+        self.auto_overlay_mask = auto_overlay_mask
+        self.max_workers = max_workers
+        self.opencv_threads = opencv_threads
+        self.queue_depth = queue_depth
+        self.use_spool = use_spool
+        self.variants = variants
+        # 逐个处理时只有一个进程，使用单进程的调优结果
+        self.single_opencv_threads = single_opencv_threads
+        self.single_queue_depth = single_queue_depth
 
     def run(self):
         try:
-            for i, video_path in enumerate(self.video_list):
-                output_path = os.path.join(self.output_dir, f"processed_{os.path.basename(video_path)}")
-                processor = VideoProcessor(video_path, output_path, self.threshold, self.min_area, self.blur_size, self.reverse_video)
-                processor.progress.connect(self.update_progress)
-                processor.run()
-                self.progress.emit(int((i + 1) / len(self.video_list) * 100), "总进度")
+            check_shared_variants(self.variants)
+            if self.max_workers > 1 and len(self.video_list) > 1:
+                self.run_parallel()
+            else:
+                for i, video_path in enumerate(self.video_list):
+                    output_path = self.get_output_path(video_path)
+                    processor = VideoProcessor(video_path, output_path, self.threshold, self.min_area, self.blur_size, self.reverse_video,
+                                               self.roi, self.exclude_rects, self.auto_overlay_mask,
+                                               self.single_opencv_threads, self.single_queue_depth, self.use_spool,
+                                               self.variants)
+                    processor.progress.connect(self.update_progress)
+                    processor.run()
+                    self.progress.emit(int((i + 1) / len(self.video_list) * 100), "总进度")
             self.finished.emit()
         except Exception as e:
             logging.exception("批量处理时发生错误")
             self.error.emit(str(e))
 
+    def get_output_path(self, video_path):
+        return os.path.join(self.output_dir, f"processed_{os.path.basename(video_path)}")
+
+    def run_parallel(self):
+        """多个视频分配到多个工作进程同时处理"""
+        params = {
+            "threshold": self.threshold,
+            "min_area": self.min_area,
+            "blur_size": self.blur_size,
+            "reverse_video": self.reverse_video,
+            "roi": self.roi,
+            "exclude_rects": self.exclude_rects or [],
+            "auto_overlay_mask": self.auto_overlay_mask,
+            "opencv_threads": self.opencv_threads,
+            "queue_depth": self.queue_depth,
+            "use_spool": self.use_spool,
+            "variants": self.variants,
+        }
+        with multiprocessing.Manager() as manager:
+            progress_queue = manager.Queue()
+            with ProcessPoolExecutor(max_workers=min(self.max_workers, len(self.video_list))) as executor:
+                futures = []
+                for i, video_path in enumerate(self.video_list):
+                    job = {"id": str(i), "input_path": video_path,
+                           "output_path": self.get_output_path(video_path), "params": params}
+                    futures.append(executor.submit(run_service_job, job, progress_queue))
+
+                done = 0
+                while done < len(futures):
+                    try:
+                        job_id, value = progress_queue.get(timeout=0.2)
+                        self.update_progress(value, os.path.basename(self.video_list[int(job_id)]))
+                    except queue.Empty:
+                        pass
+                    finished = sum(future.done() for future in futures)
+                    if finished != done:
+                        done = finished
+                        self.progress.emit(int(done / len(futures) * 100), "总进度")
+
+                for video_path, future in zip(self.video_list, futures):
+                    result = future.result()
+                    if "error" in result:
+                        logging.error(f"{video_path}: {result['error']}")
+
     def update_progress(self, value, filename):
         self.progress.emit(value, filename)
 
+def run_service_job(job, progress_queue):
+    """在工作进程中执行单个任务，进度变化时通过队列汇报给服务进程"""
+    params = job["params"]
+    processor = VideoProcessor(
+        job["input_path"],
+        job["output_path"],
+        params["threshold"],
+        params["min_area"],
+        params["blur_size"],
+        params["reverse_video"],
+        tuple(params["roi"]) if params.get("roi") else None,
+        [tuple(rect) for rect in params.get("exclude_rects", [])],
+        params.get("auto_overlay_mask", False),
+        params.get("opencv_threads"),
+        params.get("queue_depth", 0),
+        params.get("use_spool", False),
+        params.get("variants")
+    )
+    result = {"variants": []}
+    last_progress = [-1]
+
+    def report_progress(value, _filename):
+        # 每帧都会触发，只在百分比变化时跨进程发送
+        if value != last_progress[0]:
+            last_progress[0] = value
+            progress_queue.put((job["id"], value))
+
+    processor.progress.connect(report_progress)
+    processor.variant_finished.connect(lambda output_path, tw_speed, kept_frames: result["variants"].append(
+        {"output_path": output_path, "tw_speed": tw_speed, "kept_frames": kept_frames}))
+    processor.finished.connect(lambda message, tw_speed, kept_frames: result.update(
+        message=message, tw_speed=tw_speed, kept_frames=kept_frames))
+    processor.error.connect(lambda message: result.update(error=message))
+    processor.run()
+    return result
+
+class JobQueue:
+    """持久化到磁盘的任务队列，服务重启后未完成的任务会重新排队"""
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(app_dir, "job_queue.json")
+        self.jobs = OrderedDict()
+        self.next_id = 1
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.next_id = data.get("next_id", 1)
+        for job in data.get("jobs", []):
+            if job["status"] == "running":
+                job["status"] = "queued"
+                job["progress"] = 0
+            self.jobs[job["id"]] = job
+
+    def save(self):
+        # 先写临时文件再替换，避免写到一半崩溃导致队列文件损坏
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, 'w') as f:
+            json.dump({"next_id": self.next_id, "jobs": list(self.jobs.values())}, f)
+        os.replace(temp_filename, self.filename)
+
+    def add(self, input_path, output_path, params, priority=0):
+        job = {
+            "id": str(self.next_id),
+            "input_path": input_path,
+            "output_path": output_path,
+            "params": params,
+            "priority": priority,
+            "status": "queued",
+            "progress": 0,
+            "created": time.time(),
+        }
+        self.next_id += 1
+        self.jobs[job["id"]] = job
+        self.save()
+        return job
+
+    def next_job(self):
+        """返回优先级最高的排队任务，同优先级按提交顺序"""
+        queued = [job for job in self.jobs.values() if job["status"] == "queued"]
+        if not queued:
+            return None
+        return min(queued, key=lambda job: (-job["priority"], int(job["id"])))
+
+class JobService:
+    """基于 asyncio 的本地任务服务，通过 127.0.0.1 上的 HTTP/JSON 接口提交和查询任务
+
+    接口：
+        POST   /jobs             提交任务，返回任务信息
+        GET    /jobs             列出所有任务
+        GET    /jobs/<id>        查询单个任务
+        DELETE /jobs/<id>        取消排队中的任务
+        GET    /jobs/<id>/events 以 NDJSON 流的形式推送进度，任务结束后关闭连接
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, max_workers=None):
+        self.host = host
+        self.port = port
+        self.settings = Settings()
+        self.tuned = self.settings.get_tuned()
+        self.max_workers = max_workers or self.tuned.get("workers") or os.cpu_count() or 1
+        # 调优结果只适用于调优时的工作进程数，否则按工作进程数平分CPU核心，避免线程数过多
+        if self.tuned.get("workers") == self.max_workers and self.tuned.get("opencv_threads"):
+            self.opencv_threads = self.tuned["opencv_threads"]
+        else:
+            self.opencv_threads = max(1, (os.cpu_count() or 1) // self.max_workers)
+        self.queue = JobQueue()
+        self.running = 0
+        self.isolating = False
+        self.subscribers = {}
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.executor = None
+        self.restart_executor()
+        self.manager = multiprocessing.Manager()
+        self.progress_queue = self.manager.Queue()
+        threading.Thread(target=self.pump_progress, daemon=True).start()
+
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        logging.info(f"任务服务已启动: http://{self.host}:{self.port}，工作进程数={self.max_workers}")
+        print(f"任务服务已启动: http://{self.host}:{self.port}")
+        try:
+            async with server:
+                await asyncio.gather(server.serve_forever(), self.schedule())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.manager.shutdown()
+
+    def restart_executor(self):
+        # 工作进程在服务运行期间一直保留，避免每个任务重新启动进程和导入 OpenCV；
+        # 某个工作进程崩溃后整个进程池不可用，需要重新创建
+        if self.executor is not None:
+            logging.warning("工作进程池已损坏，正在重新创建")
+            self.executor.shutdown(wait=False)
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        for _ in range(self.max_workers):
+            self.executor.submit(os.getpid)
+
+    async def schedule(self):
+        while True:
+            while self.running < self.max_workers and not self.isolating:
+                job = self.queue.next_job()
+                if job is None:
+                    break
+                if job.get("crashes"):
+                    # 工作进程崩溃过的任务单独运行，以便确定是不是它导致的崩溃
+                    if self.running:
+                        break
+                    self.isolating = True
+                self.start_job(job)
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+    def start_job(self, job):
+        job["status"] = "running"
+        job["started"] = time.time()
+        self.queue.save()
+        self.running += 1
+        logging.info(f"开始任务 {job['id']}: {job['input_path']}")
+        try:
+            future = self.loop.run_in_executor(self.executor, run_service_job, job, self.progress_queue)
+        except BrokenProcessPool:
+            self.restart_executor()
+            future = self.loop.run_in_executor(self.executor, run_service_job, job, self.progress_queue)
+        future.add_done_callback(lambda f, job_id=job["id"], executor=self.executor: self.job_done(job_id, f, executor))
+
+    def job_done(self, job_id, future, executor):
+        self.running -= 1
+        self.isolating = False
+        job = self.queue.jobs[job_id]
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            # 同一进程池中正在运行的任务都会收到这个错误，无法确定是哪个任务导致的崩溃，
+            # 因此先重新排队单独运行，单独运行时仍然崩溃才标记为失败
+            if executor is self.executor:
+                self.restart_executor()
+            isolated = bool(job.get("crashes"))
+            job["crashes"] = job.get("crashes", 0) + 1
+            logging.error(f"任务 {job_id} 的工作进程异常退出（第 {job['crashes']} 次）")
+            if not isolated:
+                job["status"] = "queued"
+                job["progress"] = 0
+                self.queue.save()
+                self.publish(job_id)
+                self.wakeup.set()
+                return
+            result = {"error": "工作进程异常退出"}
+        except Exception as e:
+            logging.exception(f"任务 {job_id} 的工作进程发生错误")
+            result = {"error": str(e)}
+        if "error" in result:
+            job["status"] = "error"
+            job["message"] = result["error"]
+        else:
+            job["status"] = "done"
+            job["progress"] = 100
+            job.update(result)
+        job["finished"] = time.time()
+        self.queue.save()
+        self.publish(job_id, final=True)
+        self.wakeup.set()
+
+    def pump_progress(self):
+        while True:
+            try:
+                job_id, value = self.progress_queue.get()
+                self.loop.call_soon_threadsafe(self.update_progress, job_id, value)
+            except (EOFError, OSError, RuntimeError):
+                # 服务关闭时 Manager 或事件循环已经停止
+                return
+
+    def update_progress(self, job_id, value):
+        job = self.queue.jobs.get(job_id)
+        if job is not None and job["status"] == "running":
+            job["progress"] = value
+            self.publish(job_id)
+
+    def publish(self, job_id, final=False):
+        for subscriber in self.subscribers.get(job_id, []):
+            subscriber.put_nowait(dict(self.queue.jobs[job_id]))
+            if final:
+                subscriber.put_nowait(None)
+
+    def create_job(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError("请求内容必须是 JSON 对象")
+        input_path = spec.get("input_path")
+        if not input_path or not os.path.isfile(input_path):
+            raise ValueError("input_path 不存在")
+        output_path = spec.get("output_path")
+        if not output_path:
+            input_name = os.path.splitext(os.path.basename(input_path))[0]
+            output_path = os.path.join(os.path.dirname(input_path), f"{input_name}_processed.mp4")
+        params = {
+            "threshold": self.settings.get("threshold"),
+            "min_area": self.settings.get("min_area"),
+            "blur_size": self.settings.get("blur_size"),
+            "reverse_video": self.settings.get("reverse_video"),
+            "roi": parse_roi(self.settings.get("roi")),
+            "exclude_rects": parse_rects(self.settings.get("exclude_rects")),
+            "auto_overlay_mask": self.settings.get("auto_overlay_mask"),
+            "opencv_threads": self.opencv_threads,
+            "queue_depth": self.tuned.get("queue_depth", 0),
+            "use_spool": self.settings.get("use_spool"),
+            "variants": self.settings.get("output_variants") or None,
+        }
+        params.update({key: value for key, value in spec.items() if key in params})
+        self.validate_params(params, output_path)
+        job = self.queue.add(input_path, output_path, params, int(spec.get("priority", 0)))
+        self.wakeup.set()
+        return job
+
+    def validate_params(self, params, output_path):
+        """提交时检查客户端传入的参数，避免任务排队后才在工作进程中出错"""
+        # 检测区域和排除区域既可以用设置中的文本格式，也可以用 [x, y, w, h] 列表
+        roi = params["roi"]
+        if isinstance(roi, str):
+            roi = parse_roi(roi)
+        params["roi"] = None if roi is None else to_rect(roi)
+
+        exclude_rects = params["exclude_rects"]
+        if isinstance(exclude_rects, str):
+            exclude_rects = parse_rects(exclude_rects)
+        if not isinstance(exclude_rects, (list, tuple)):
+            raise ValueError("exclude_rects 必须是文本或矩形列表")
+        params["exclude_rects"] = [to_rect(rect) for rect in exclude_rects]
+
+        variants = params["variants"]
+        if variants is not None:
+            if not isinstance(variants, list) or not all(isinstance(variant, dict) for variant in variants):
+                raise ValueError("variants 必须是 JSON 对象列表")
+        check_shared_variants(variants)
+        check_unique_output_paths([variant_output_path(output_path, variant) for variant in variants or [{}]])
+
+    async def handle_client(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            await self.route(method, path.split('?', 1)[0].rstrip('/'), body, writer)
+        except (ValueError, KeyError) as e:
+            await self.send_json(writer, 400, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.exception("处理任务服务请求时发生错误")
+            await self.send_json(writer, 500, {"error": str(e)})
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body, writer):
+        parts = path.strip('/').split('/')
+        if parts[0] != 'jobs' or len(parts) > 3:
+            return await self.send_json(writer, 404, {"error": "未找到"})
+        if len(parts) == 1:
+            if method == 'GET':
+                return await self.send_json(writer, 200, list(self.queue.jobs.values()))
+            if method == 'POST':
+                return await self.send_json(writer, 201, self.create_job(json.loads(body or b'{}')))
+            return await self.send_json(writer, 405, {"error": "不支持的请求方法"})
+
+        job = self.queue.jobs.get(parts[1])
+        if job is None:
+            return await self.send_json(writer, 404, {"error": "任务不存在"})
+        if len(parts) == 3:
+            if parts[2] != 'events' or method != 'GET':
+                return await self.send_json(writer, 404, {"error": "未找到"})
+            return await self.stream_events(job, writer)
+        if method == 'GET':
+            return await self.send_json(writer, 200, job)
+        if method == 'DELETE':
+            if job["status"] != "queued":
+                return await self.send_json(writer, 409, {"error": "只能取消排队中的任务"})
+            job["status"] = "cancelled"
+            self.queue.save()
+            self.publish(job["id"], final=True)
+            return await self.send_json(writer, 200, job)
+        return await self.send_json(writer, 405, {"error": "不支持的请求方法"})
+
+    async def stream_events(self, job, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n")
+        writer.write(json.dumps(job, ensure_ascii=False).encode() + b"\n")
+        await writer.drain()
+        if job["status"] not in ("queued", "running"):
+            return
+        subscriber = asyncio.Queue()
+        self.subscribers.setdefault(job["id"], []).append(subscriber)
+        try:
+            while True:
+                event = await subscriber.get()
+                if event is None:
+                    break
+                writer.write(json.dumps(event, ensure_ascii=False).encode() + b"\n")
+                await writer.drain()
+        finally:
+            self.subscribers[job["id"]].remove(subscriber)
+
+    async def send_json(self, writer, status, payload):
+        reasons = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found",
+                   405: "Method Not Allowed", 409: "Conflict", 500: "Internal Server Error"}
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
 class App(QWidget):
     def __init__(self):
         super().__init__()
@@ -425,7 +1475,28 @@ class App(QWidget):
 
         self.reverse_video = QCheckBox('倒放视频')
         self.reverse_video.setChecked(False)
-        param_layout.addWidget(self.reverse_video, 3, 0, 1, 4)
+        param_layout.addWidget(self.reverse_video, 3, 0, 1, 2)
+
+        self.both_directions = QCheckBox('同时输出正放和倒放版本')
+        self.both_directions.setChecked(False)
+        param_layout.addWidget(self.both_directions, 3, 2, 1, 2)
+
+        self.preview_check = QCheckBox('实时预览（采样估算保留帧数）')
+        self.preview_check.toggled.connect(self.toggle_preview)
+        param_layout.addWidget(self.preview_check, 4, 0, 1, 4)
+
+        self.preview_label = QLabel('')
+        param_layout.addWidget(self.preview_label, 5, 0, 1, 4)
+
+        # 拖动滑块时合并短时间内的多次变化，只重新估算一次
+        self.preview_data = None
+        self.retired_preview_samplers = []
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(50)
+        self.preview_timer.timeout.connect(self.update_preview)
+        for slider in (self.阈值_slider, self.最小变化区域_slider, self.模糊程度_slider):
+            slider.valueChanged.connect(lambda _: self.preview_timer.start())
 
         param_group.setLayout(param_layout)
         main_layout.addWidget(param_group)
@@ -468,6 +1539,10 @@ class App(QWidget):
         self.batch_process_button.clicked.connect(self.batch_process_videos)
         process_layout.addWidget(self.batch_process_button)
 
+        self.tune_button = QPushButton('性能自动调优')
+        self.tune_button.clicked.connect(self.auto_tune)
+        process_layout.addWidget(self.tune_button)
+
         self.progress_bar = AnimatedProgressBar()
         self.progress_bar.setTextVisible(False)
         process_layout.addWidget(self.progress_bar)
@@ -552,6 +1627,7 @@ class App(QWidget):
             self.input_path = fname
             if self.output_mode.currentText() == '自动生成':
                 self.generate_output_path()
+            self.start_preview()
 
     def toggle_output_selection(self, index):
         if index == 0:  # 自动生成
@@ -588,6 +1664,64 @@ class App(QWidget):
         dialog = SettingsDialog(self.settings, self)
         if dialog.exec_():
             self.load_settings()
+            self.start_preview()
+
+    def toggle_preview(self, checked):
+        if checked:
+            self.start_preview()
+        else:
+            self.stop_preview()
+            self.preview_data = None
+            self.preview_label.setText('')
+
+    def stop_preview(self, wait=False):
+        sampler = getattr(self, 'preview_sampler', None)
+        self.preview_sampler = None
+        if sampler is not None and sampler.isRunning():
+            # 不在界面线程里等待旧的采样线程结束，只断开信号，让它自己退出
+            sampler.sampled.disconnect()
+            sampler.error.disconnect()
+            sampler.requestInterruption()
+            self.retired_preview_samplers.append(sampler)
+            sampler.finished.connect(lambda: self.retired_preview_samplers.remove(sampler))
+        if wait:
+            for retired in list(self.retired_preview_samplers):
+                retired.wait()
+
+    def start_preview(self):
+        if not self.preview_check.isChecked() or not hasattr(self, 'input_path'):
+            return
+        self.stop_preview()
+        self.preview_data = None
+        self.preview_label.setText('正在采样预览帧...')
+        self.preview_sampler = PreviewSampler(self.input_path, *self.get_mask_options())
+        self.preview_sampler.sampled.connect(self.preview_sampled)
+        self.preview_sampler.error.connect(self.preview_error)
+        self.preview_sampler.start()
+
+    def preview_sampled(self, preview_data):
+        # 断开信号前已经排队的旧结果直接丢弃
+        if self.sender() is not self.preview_sampler:
+            return
+        self.preview_data = preview_data
+        self.update_preview()
+
+    def preview_error(self, message):
+        if self.sender() is self.preview_sampler:
+            self.preview_label.setText(message)
+
+    def update_preview(self):
+        if self.preview_data is None:
+            return
+        kept_frames, tw_speed = estimate_kept_frames(
+            self.preview_data,
+            self.阈值_slider.value(),
+            self.最小变化区域_slider.value(),
+            self.模糊程度_slider.value()
+        )
+        deeper_red = QColor(255, 100, 100)
+        self.preview_label.setText(f"预计保留约 <font color='{deeper_red.name()}'>{kept_frames}</font> 帧，"
+                                   f"TW速度约 <font color='{deeper_red.name()}'>{tw_speed:.2f}%</font>")
 
     def load_settings(self):
         self.阈值_slider.setValue(self.settings.get("threshold"))
@@ -595,6 +1729,26 @@ class App(QWidget):
         self.模糊程度_slider.setValue(self.settings.get("blur_size"))
         self.reverse_video.setChecked(self.settings.get("reverse_video"))
 
+    def get_mask_options(self):
+        return (parse_roi(self.settings.get("roi")),
+                parse_rects(self.settings.get("exclude_rects")),
+                self.settings.get("auto_overlay_mask"))
+
+    def get_output_variants(self):
+        """一次解码同时生成的多个输出版本，没有额外版本时返回 None"""
+        variants = list(self.settings.get("output_variants")) or [{}]
+        if self.both_directions.isChecked():
+            reversed_variants = []
+            for variant in variants:
+                reversed_variant = {key: value for key, value in variant.items() if key != "output_path"}
+                reverse_video = not variant.get("reverse_video", self.reverse_video.isChecked())
+                reversed_variant["reverse_video"] = reverse_video
+                # 文件名后缀按新增版本实际的播放方向命名
+                reversed_variant["suffix"] = variant.get("suffix", "") + ("_reversed" if reverse_video else "_forward")
+                reversed_variants.append(reversed_variant)
+            variants += reversed_variants
+        return variants if variants != [{}] else None
+
     def process_video(self):
         if not hasattr(self, 'input_path'):
             self.status_label.setText('请选择输入视频。')
@@ -605,13 +1759,19 @@ class App(QWidget):
 
         try:
             logging.info("开始视频处理")
+            tuned = self.settings.get_tuned()
             self.processor = VideoProcessor(
                 self.input_path, 
                 self.output_path, 
                 self.阈值_slider.value(),
                 self.最小变化区域_slider.value(),
                 self.模糊程度_slider.value(),
-                self.reverse_video.isChecked()
+                self.reverse_video.isChecked(),
+                *self.get_mask_options(),
+                opencv_threads=tuned.get("single_opencv_threads"),
+                queue_depth=tuned.get("single_queue_depth", 0),
+                use_spool=self.settings.get("use_spool"),
+                variants=self.get_output_variants()
             )
             self.processor.progress.connect(self.update_progress)
             self.processor.finished.connect(self.process_finished)
@@ -634,6 +1794,7 @@ class App(QWidget):
             return
 
         video_list = [self.video_list.item(i).text() for i in range(self.video_list.count())]
+        tuned = self.settings.get_tuned()
         
         self.batch_processor = BatchProcessor(
             video_list,
@@ -641,7 +1802,15 @@ class App(QWidget):
             self.阈值_slider.value(),
             self.最小变化区域_slider.value(),
             self.模糊程度_slider.value(),
-            self.reverse_video.isChecked()
+            self.reverse_video.isChecked(),
+            *self.get_mask_options(),
+            max_workers=tuned.get("workers", 1),
+            opencv_threads=tuned.get("opencv_threads"),
+            queue_depth=tuned.get("queue_depth", 0),
+            single_opencv_threads=tuned.get("single_opencv_threads"),
+            single_queue_depth=tuned.get("single_queue_depth", 0),
+            use_spool=self.settings.get("use_spool"),
+            variants=self.get_output_variants()
         )
         self.batch_processor.progress.connect(self.update_batch_progress)
         self.batch_processor.finished.connect(self.batch_process_finished)
@@ -652,6 +1821,33 @@ class App(QWidget):
         self.batch_process_button.setEnabled(False)
         self.status_label.setText('批量处理中...')
 
+    def auto_tune(self):
+        if hasattr(self, 'input_path'):
+            sample_path = self.input_path
+        elif self.video_list.count() > 0:
+            sample_path = self.video_list.item(0).text()
+        else:
+            QMessageBox.warning(self, "警告", "请先选择输入视频或添加批量处理视频，调优会使用它的开头一小段")
+            return
+
+        self.tuner = AutoTuner(sample_path, self.settings)
+        self.tuner.progress.connect(self.update_progress)
+        self.tuner.finished.connect(self.auto_tune_finished)
+        self.tuner.error.connect(self.process_error)
+        self.tuner.start()
+        self.process_button.setEnabled(False)
+        self.batch_process_button.setEnabled(False)
+        self.tune_button.setEnabled(False)
+        self.status_label.setText('性能调优中...')
+
+    def auto_tune_finished(self, config):
+        self.process_button.setEnabled(True)
+        self.batch_process_button.setEnabled(True)
+        self.tune_button.setEnabled(True)
+        self.progress_bar.setValue(100)
+        self.status_label.setText(f"调优完成：工作进程 {config['workers']}，OpenCV线程 {config['opencv_threads']}，"
+                                  f"预读队列 {config['queue_depth']}，约 {config['fps']:.0f} 帧/秒")
+
     def update_progress(self, value, filename):
         self.progress_bar.setValue(value)
         self.status_label.setText(f'正在处理: {filename} - {value}%')
@@ -683,6 +1879,7 @@ class App(QWidget):
         self.status_label.setText(error_message)
         self.process_button.setEnabled(True)
         self.batch_process_button.setEnabled(True)
+        self.tune_button.setEnabled(True)
         QMessageBox.critical(self, "错误", error_message)
 
     def check_watermark(self):
@@ -742,6 +1939,7 @@ class App(QWidget):
         """
 
     def closeEvent(self, event):
+        self.stop_preview(wait=True)
         # 正常关闭程序时删除日志文件
         if os.path.exists(log_file):
             try:
@@ -766,8 +1964,17 @@ def exception_hook(exctype, value, traceback):
 if __name__ == '__main__':
     sys.excepthook = exception_hook
     a1b2c3d4e5f6g7h8i9j0(validate_watermark)
+    cleanup_stale_spools()
+    parser = argparse.ArgumentParser(description=app_name)
+    parser.add_argument('--serve', action='store_true', help='以本地任务服务模式运行，不启动界面')
+    parser.add_argument('--port', type=int, default=8765, help='任务服务监听的端口（仅绑定 127.0.0.1）')
+    parser.add_argument('--workers', type=int, default=None, help='工作进程数，默认使用自动调优结果或 CPU 核心数')
+    args, qt_args = parser.parse_known_args()
+    if args.serve:
+        JobService(port=args.port, max_workers=args.workers).serve_forever()
+        sys.exit(0)
     try:
-        app = QApplication(sys.argv)
+        app = QApplication(sys.argv[:1] + qt_args)
         ex = App()
         ex.show()
         sys.exit(app.exec_())